@@ -1,17 +1,24 @@
 import dotenv
 import uvicorn 
 import re
-import json
+import orjson
 import os
+import logging
+from cachetools import TTLCache
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
-import uuid
+import secrets
 import asyncio
+import time
+import httpx
+from contextlib import asynccontextmanager
 dotenv.load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Pydantic Models
 class StartRequest(BaseModel):
     message:str
@@ -29,7 +36,22 @@ from langchain_openai import ChatOpenAI
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 
 
-app = FastAPI()
+llm: Optional[ChatOpenAI] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One keep-alive HTTP/2 pool shared by every request, so inquiries reuse
+    # warm connections to OpenAI instead of paying TLS/TCP handshakes each time
+    global llm
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+    )
+    llm = ChatOpenAI(model="gpt-4o", temperature=0.8, http_async_client=http_client)
+    yield
+    await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -49,9 +71,62 @@ app.add_middleware(
 def read_root():
     return {"message": "Inquiry System API"}
 
-llm = ChatOpenAI(model="gpt-4o", temperature=0.8)
-
-conversations_db: Dict[str, List[Any]] = {}
+# Conversation histories (conversation_id -> list of messages). Bounded so
+# abandoned conversations can't grow memory forever: least-recently-written
+# entries are evicted past 10k live conversations or 30 minutes of age.
+conversations_db: TTLCache = TTLCache(maxsize=10_000, ttl=1800)
+
+# Lowercase sentinel that marks the final refined query in the model output.
+# The streaming loops only scan a rolling tail of this length plus the newest
+# chunk, so detection stays linear in the total number of streamed characters.
+_SENTINEL = "here's your refined query:"
+_SENTINEL_OVERLAP = len(_SENTINEL) - 1
+
+# Token frames are coalesced into one SSE frame per window to amortize the
+# per-frame ASGI send / chunked-encoding / socket flush cost
+_FLUSH_CHARS = 64
+_FLUSH_INTERVAL = 0.03  # seconds
+
+# The prompt makes the sentinel lead the final answer, so a response this long
+# without one is off-script; past it the streams stop paying the per-chunk scan
+_MAX_SENTINEL_SCAN_CHARS = 32_000
+
+# Static SSE frame skeletons: the framing of the done/error/final_query
+# payloads never changes, so only the dynamic fields are serialized on emit
+_FINAL_QUERY_PREFIX = b'data: {"type": "final_query", "refined_query": '
+_DONE_PREFIX = b'data: {"type": "done", "conversation_id": "'
+_DONE_QUESTION = b'", "question": '
+_ERROR_PREFIX = b'data: {"type": "error", "content": '
+_FRAME_END = b'}\n\n'
+_ERROR_NOT_FOUND_FRAME = _ERROR_PREFIX + b'"Conversation not found."' + _FRAME_END
+
+# Closing phrases the model sometimes tacks onto the refined query despite
+# instructions. One compiled case-insensitive alternation finds the earliest
+# occurrence in a single linear pass, with no lowercased copy of the query.
+_CLOSING_PHRASES = ('hope this helps', 'does that help', 'hope that helps', 'let me know', 'hope this', 'does that')
+_CLOSING_PHRASE_RE = re.compile("|".join(re.escape(phrase) for phrase in _CLOSING_PHRASES), re.IGNORECASE)
+
+# Pull the refined query out of a completed model response. Returns None when
+# the sentinel is absent or nothing usable follows it. All three inquiry
+# endpoints share this, so the hot string handling lives in one code object.
+def _extract_refined_query(full_content: str) -> Optional[str]:
+    sentinel_idx = full_content.lower().find(_SENTINEL)
+    if sentinel_idx == -1:
+        return None
+    query_text = full_content[sentinel_idx + len(_SENTINEL):].strip()
+
+    # Everything up to the first paragraph break is the query; partition does
+    # one C-level pass with no list allocation and keeps multi-line queries
+    # intact. Leading whitespace is already stripped, so rstrip suffices.
+    query = query_text.partition('\n\n')[0].rstrip()
+
+    # Remove any trailing phrases like "Hope this helps!" that might be on
+    # the same line - truncate at the earliest closing phrase, if any
+    closing_match = _CLOSING_PHRASE_RE.search(query)
+    if closing_match:
+        query = query[:closing_match.start()].rstrip()
+
+    return query or None
 
 SYSTEM_PROMPT = """
 You are a helpful, friendly person helping someone refine their request. Talk naturally, like you're having a real conversation.
@@ -81,13 +156,17 @@ When outputting the final query:
 Write like a real person would talk - natural, warm, and helpful. Avoid sounding like a robot or following a rigid script.
 """
 
+# Built once: the prompt never changes, so every conversation shares one
+# SystemMessage instead of validating a fresh Pydantic object per request
+SYSTEM_MSG = SystemMessage(content=SYSTEM_PROMPT)
+
 
 @app.post("/inquire/start/stream")
 async def start_inquiry_stream(request:StartRequest):
-    conversation_id = str(uuid.uuid4())
+    conversation_id = secrets.token_urlsafe(16)
 
     history = [
-        SystemMessage(content=SYSTEM_PROMPT),
+        SYSTEM_MSG,
         HumanMessage(content=request.message)
     ]
     
@@ -96,65 +175,102 @@ async def start_inquiry_stream(request:StartRequest):
     conversations_db[conversation_id] = history
 
     async def generate():
-        full_content = ""
+        chunks_buf: List[str] = []
+        total_len = 0
         found_final_query = False
+        sentinel_possible = True
         content_before_final = ""
-        
-        async for chunk in llm.astream(history):
+        tail_lower = ""
+        # SSE frame template built once per request; only the token text
+        # varies per chunk, so each frame is one orjson call plus a concat
+        token_prefix = (
+            b'data: {"type": "token", "conversation_id": "'
+            + conversation_id.encode() + b'", "content": '
+        )
+
+        # Coalescing buffer: tokens are batched into one frame per
+        # _FLUSH_CHARS chars or _FLUSH_INTERVAL seconds, whichever first
+        pending: List[str] = []
+        pending_len = 0
+        pending_start = 0.0
+
+        stream = llm.astream(history).__aiter__()
+        next_chunk = asyncio.ensure_future(anext(stream))
+        while True:
+            # Wait for the next chunk, but no longer than the flush deadline
+            # of pending tokens; a timeout flushes without cancelling the
+            # in-flight fetch
+            timeout = None
+            if pending:
+                timeout = max(0.0, _FLUSH_INTERVAL - (time.monotonic() - pending_start))
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            if not done:
+                yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+                pending.clear()
+                pending_len = 0
+                continue
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            next_chunk = asyncio.ensure_future(anext(stream))
+
             if chunk.content:
-                full_content += chunk.content
-                
+                chunks_buf.append(chunk.content)
+                total_len += len(chunk.content)
+
                 # Check if we detected "Here's your refined query:" phrase
-                if not found_final_query:
-                    if "here's your refined query:" in full_content.lower():
+                # Only the rolling tail is lowercased, not the whole buffer
+                if not found_final_query and sentinel_possible:
+                    tail_lower += chunk.content.lower()
+                    if _SENTINEL in tail_lower:
                         found_final_query = True
+                        # Drop unsent tokens; the refined query goes out as a
+                        # single final_query frame after the stream completes
+                        pending.clear()
+                        pending_len = 0
+                        # Materialize the buffer once, only on detection
+                        full_content = "".join(chunks_buf)
                         # Extract content before the phrase (should be empty per instructions, but just in case)
-                        prefix_match = re.search(r"here's your refined query:\s*", full_content, re.IGNORECASE)
-                        if prefix_match:
-                            content_before_final = full_content[:prefix_match.start()].strip()
+                        sentinel_idx = full_content.lower().find(_SENTINEL)
+                        if sentinel_idx != -1:
+                            content_before_final = full_content[:sentinel_idx].strip()
                         # Stop sending tokens to frontend immediately
                         # But continue accumulating all remaining chunks
                     else:
-                        # Still streaming normally, send tokens
-                        yield f"data: {json.dumps({'type': 'token', 'content': chunk.content, 'conversation_id': conversation_id})}\n\n"
+                        # Keep just enough tail to catch a sentinel spanning chunks
+                        tail_lower = tail_lower[-_SENTINEL_OVERLAP:]
+                        if total_len > _MAX_SENTINEL_SCAN_CHARS:
+                            # Off-script long response; give up on the sentinel
+                            sentinel_possible = False
+                            tail_lower = ""
+
+                if not found_final_query:
+                    if not pending:
+                        pending_start = time.monotonic()
+                    pending.append(chunk.content)
+                    pending_len += len(chunk.content)
+                    if pending_len >= _FLUSH_CHARS:
+                        yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+                        pending.clear()
+                        pending_len = 0
                 # If found_final_query is True, we're accumulating but not sending
-        
+
+        # Flush tokens still pending when the stream ended
+        if pending:
+            yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+
+        full_content = "".join(chunks_buf)
+
         # After all chunks are received, extract the complete final query
         if found_final_query:
-            prefix_match = re.search(r"here's your refined query:\s*", full_content, re.IGNORECASE)
-            if prefix_match:
-                query_start = prefix_match.end()
-                query_text = full_content[query_start:].strip()
-                
-                # Extract everything after "Here's your refined query:" until double newline (paragraph break) or end
-                # This captures the full query even if it spans multiple lines
-                query_lines = query_text.split('\n\n')
-                if query_lines:
-                    # If there's a double newline, take everything before it (the query)
-                    query = query_lines[0].strip()
-                else:
-                    # No double newline, take everything but clean up trailing single newlines
-                    # Remove trailing newlines but keep the content
-                    query = query_text.rstrip('\n').strip()
-                
-                # Remove any trailing phrases like "Hope this helps!" that might be on same line
-                # Look for common closing phrases and remove them
-                closing_phrases = ['hope this helps', 'does that help', 'hope that helps', 'let me know', 'hope this', 'does that']
-                query_lower = query.lower()
-                for phrase in closing_phrases:
-                    if phrase in query_lower:
-                        # Find and remove the phrase and everything after it
-                        idx = query_lower.find(phrase)
-                        query = query[:idx].strip()
-                        break
-                
-                if query:
-                    # Only delete if conversation exists (should always exist, but safe check)
-                    if conversation_id in conversations_db:
-                        del conversations_db[conversation_id]
-                    formatted_query = f"User wants to say this: {query}"
-                    yield f"data: {json.dumps({'type': 'final_query', 'refined_query': formatted_query})}\n\n"
-                    return
+            query = _extract_refined_query(full_content)
+            if query:
+                # pop tolerates the entry having been evicted already
+                conversations_db.pop(conversation_id, None)
+                formatted_query = f"User wants to say this: {query}"
+                yield _FINAL_QUERY_PREFIX + orjson.dumps(formatted_query) + _FRAME_END
+                return
         
         # If not a final query, update stored conversation and send done message
         ai_message = AIMessage(content=full_content)
@@ -162,21 +278,21 @@ async def start_inquiry_stream(request:StartRequest):
         conversations_db[conversation_id] = history
         
         # Send final message
-        yield f"data: {json.dumps({'type': 'done', 'conversation_id': conversation_id, 'question': full_content})}\n\n"
+        yield _DONE_PREFIX + conversation_id.encode() + _DONE_QUESTION + orjson.dumps(full_content) + _FRAME_END
 
     return StreamingResponse(generate(), media_type="text/event-stream")
 
 @app.post("/inquire/start", response_model=ApiResponse)
 async def start_inquiry(request:StartRequest):
-    conversation_id = str(uuid.uuid4())
+    conversation_id = secrets.token_urlsafe(16)
 
     history = [
-        SystemMessage(content=SYSTEM_PROMPT),
+        SYSTEM_MSG,
         HumanMessage(content=request.message)
     ]
 
-    response = llm.invoke(history)
-    
+    response = await llm.ainvoke(history)
+
     history.append(response)
 
     conversations_db[conversation_id] = history
@@ -185,93 +301,126 @@ async def start_inquiry(request:StartRequest):
 
 @app.post("/inquire/continue/stream")
 async def continue_inquiry_stream(request:ContinueRequest):
-    print(f"Continue request - conversation_id: {request.conversation_id}")
-    print(f"Available conversations: {list(conversations_db.keys())}")
-    
+    logger.debug("Continue request - conversation_id: %s (%d live conversations)",
+                 request.conversation_id, len(conversations_db))
+
+
     if request.conversation_id not in conversations_db:
         async def error_generate():
-            yield f"data: {json.dumps({'type': 'error', 'content': 'Conversation not found.'})}\n\n"
+            yield _ERROR_NOT_FOUND_FRAME
         return StreamingResponse(error_generate(), media_type="text/event-stream")
     
     try:
-        # Get history - check again in case it was deleted between check and access
-        if request.conversation_id not in conversations_db:
-            async def error_generate():
-                yield f"data: {json.dumps({'type': 'error', 'content': 'Conversation not found.'})}\n\n"
-            return StreamingResponse(error_generate(), media_type="text/event-stream")
-        
-        history = list(conversations_db[request.conversation_id])  # Create a new list
+        # Mutate the stored history in place; asyncio runs one request step at
+        # a time, so there is no concurrent access to copy against
+        history = conversations_db[request.conversation_id]
         history.append(HumanMessage(content=request.answer))
 
         async def generate():
-            full_content = ""
+            chunks_buf: List[str] = []
+            total_len = 0
             found_final_query = False
-            
-            async for chunk in llm.astream(history):
+            sentinel_possible = True
+            tail_lower = ""
+            # SSE frame template built once per request; only the token text
+            # varies per chunk, so each frame is one orjson call plus a concat
+            token_prefix = (
+                b'data: {"type": "token", "conversation_id": "'
+                + request.conversation_id.encode() + b'", "content": '
+            )
+
+            # Coalescing buffer: tokens are batched into one frame per
+            # _FLUSH_CHARS chars or _FLUSH_INTERVAL seconds, whichever first
+            pending: List[str] = []
+            pending_len = 0
+            pending_start = 0.0
+
+            stream = llm.astream(history).__aiter__()
+            next_chunk = asyncio.ensure_future(anext(stream))
+            while True:
+                # Wait for the next chunk, but no longer than the flush deadline
+                # of pending tokens; a timeout flushes without cancelling the
+                # in-flight fetch
+                timeout = None
+                if pending:
+                    timeout = max(0.0, _FLUSH_INTERVAL - (time.monotonic() - pending_start))
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                if not done:
+                    yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+                    pending.clear()
+                    pending_len = 0
+                    continue
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                next_chunk = asyncio.ensure_future(anext(stream))
+
                 if chunk.content:
-                    full_content += chunk.content
-                    
+                    chunks_buf.append(chunk.content)
+                    total_len += len(chunk.content)
+
                     # Check if we detected "Here's your refined query:" phrase
-                    if not found_final_query:
-                        if "here's your refined query:" in full_content.lower():
+                    # Only the rolling tail is lowercased, not the whole buffer
+                    if not found_final_query and sentinel_possible:
+                        tail_lower += chunk.content.lower()
+                        if _SENTINEL in tail_lower:
                             found_final_query = True
+                            # Drop unsent tokens; the refined query goes out as a
+                            # single final_query frame after the stream completes
+                            pending.clear()
+                            pending_len = 0
                             # Stop sending tokens to frontend immediately
                             # But continue accumulating all remaining chunks
                         else:
-                            # Still streaming normally, send tokens
-                            yield f"data: {json.dumps({'type': 'token', 'content': chunk.content, 'conversation_id': request.conversation_id})}\n\n"
+                            # Keep just enough tail to catch a sentinel spanning chunks
+                            tail_lower = tail_lower[-_SENTINEL_OVERLAP:]
+                            if total_len > _MAX_SENTINEL_SCAN_CHARS:
+                                # Off-script long response; give up on the sentinel
+                                sentinel_possible = False
+                                tail_lower = ""
+
+                    if not found_final_query:
+                        if not pending:
+                            pending_start = time.monotonic()
+                        pending.append(chunk.content)
+                        pending_len += len(chunk.content)
+                        if pending_len >= _FLUSH_CHARS:
+                            yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+                            pending.clear()
+                            pending_len = 0
                     # If found_final_query is True, we're accumulating but not sending
-            
+
+            # Flush tokens still pending when the stream ended
+            if pending:
+                yield token_prefix + orjson.dumps("".join(pending)) + b"}\n\n"
+
+            full_content = "".join(chunks_buf)
+
             # After all chunks are received, extract the complete final query
             if found_final_query:
-                prefix_match = re.search(r"here's your refined query:\s*", full_content, re.IGNORECASE)
-                if prefix_match:
-                    query_start = prefix_match.end()
-                    query_text = full_content[query_start:].strip()
-                    
-                    # Extract everything after "Here's your refined query:" until double newline (paragraph break) or end
-                    # This captures the full query even if it spans multiple lines
-                    query_lines = query_text.split('\n\n')
-                    if query_lines:
-                        # If there's a double newline, take everything before it (the query)
-                        query = query_lines[0].strip()
-                    else:
-                        # No double newline, take everything but clean up trailing single newlines
-                        # Remove trailing newlines but keep the content
-                        query = query_text.rstrip('\n').strip()
-                    
-                    # Remove any trailing phrases like "Hope this helps!" that might be on same line
-                    # Look for common closing phrases and remove them
-                    closing_phrases = ['hope this helps', 'does that help', 'hope that helps', 'let me know', 'hope this', 'does that']
-                    query_lower = query.lower()
-                    for phrase in closing_phrases:
-                        if phrase in query_lower:
-                            # Find and remove the phrase and everything after it
-                            idx = query_lower.find(phrase)
-                            query = query[:idx].strip()
-                            break
-                    
-                    if query:
-                        # Only delete if conversation exists
-                        if request.conversation_id in conversations_db:
-                            del conversations_db[request.conversation_id]
-                        formatted_query = f"User wants to say this: {query}"
-                        yield f"data: {json.dumps({'type': 'final_query', 'refined_query': formatted_query})}\n\n"
-                        return
+                query = _extract_refined_query(full_content)
+                if query:
+                    # pop tolerates the entry having been evicted already
+                    conversations_db.pop(request.conversation_id, None)
+                    formatted_query = f"User wants to say this: {query}"
+                    yield _FINAL_QUERY_PREFIX + orjson.dumps(formatted_query) + _FRAME_END
+                    return
             
-            # Continue conversation
+            # Continue conversation. Re-insert the history: the assignment
+            # refreshes the entry's TTL on activity and restores it if it was
+            # evicted mid-stream, which the in-place append alone would not
             ai_message = AIMessage(content=full_content)
             history.append(ai_message)
-            # Only update if conversation still exists (might have been deleted in race condition)
-            if request.conversation_id in conversations_db:
-                conversations_db[request.conversation_id] = history
-            
-            yield f"data: {json.dumps({'type': 'done', 'conversation_id': request.conversation_id, 'question': full_content})}\n\n"
+            conversations_db[request.conversation_id] = history
+
+
+            yield _DONE_PREFIX + request.conversation_id.encode() + _DONE_QUESTION + orjson.dumps(full_content) + _FRAME_END
         
         return StreamingResponse(generate(), media_type="text/event-stream")
     except Exception as e:
         async def error_generate():
-            yield f"data: {json.dumps({'type': 'error', 'content': str(e)})}\n\n"
+            yield _ERROR_PREFIX + orjson.dumps(str(e)) + _FRAME_END
         return StreamingResponse(error_generate(), media_type="text/event-stream")
 
 @app.post("/inquire/continue", response_model=ApiResponse)
@@ -283,22 +432,18 @@ async def continue_inquiry(request:ContinueRequest):
         history = conversations_db[request.conversation_id]
         history.append(HumanMessage(content=request.answer))
 
-        response = llm.invoke(history)
-
-        response_content = response.content
-        if "here's your refined query:" in response_content.lower():
-            # Extract query after "Here's your refined query:"
-            match = re.search(r"here's your refined query:\s*(.+?)(?:\n\n|\n$|$)", response_content, re.IGNORECASE | re.DOTALL)
-            if match:
-                query = match.group(1).strip().split('\n')[0].strip()
-                # Only delete if conversation exists
-                if request.conversation_id in conversations_db:
-                    del conversations_db[request.conversation_id]
-                # Format as system reference
-                formatted_query = f"User wants to say this: {query}"
-                return ApiResponse(refined_query=formatted_query)
+        response = await llm.ainvoke(history)
+
+        query = _extract_refined_query(response.content)
+        if query:
+            # pop tolerates the entry having been evicted already
+            conversations_db.pop(request.conversation_id, None)
+            # Format as system reference
+            formatted_query = f"User wants to say this: {query}"
+            return ApiResponse(refined_query=formatted_query)
         
         # Continue conversation (either no final_query tag or extraction failed)
+        # Re-insert the history so the entry's TTL is refreshed on activity
         history.append(response)
         conversations_db[request.conversation_id] = history
         return ApiResponse(conversation_id=request.conversation_id, question=response.content)